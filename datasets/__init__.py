@@ -207,7 +207,8 @@ def get_dataset(args, config):
         dataset = ImageDataset(os.path.join(args.exp, 'datasets', 'us_images'),
                                     os.path.join(args.exp, 'deblur_us.txt'),
                                     image_size=config.data.image_size,
-                                    normalize=False)
+                                    normalize=False,
+                                    mode='L' if config.data.channels == 1 else 'RGB')
         test_dataset = dataset
         
         
@@ -23,12 +23,12 @@ class CenterCropLongEdge(object):
     def __repr__(self):
         return self.__class__.__name__
 
-def pil_loader(path):
+def pil_loader(path, mode='RGB'):
     # open path as file to avoid ResourceWarning
     # (https://github.com/python-pillow/Pillow/issues/835)
     with open(path, 'rb') as f:
         img = Image.open(f)
-        return img.convert('RGB')
+        return img.convert(mode)
 
 
 def accimage_loader(path):
@@ -39,12 +39,12 @@ def accimage_loader(path):
         # Potentially a decoding problem, fall back to PIL.Image
         return pil_loader(path)
 
-def default_loader(path):
+def default_loader(path, mode='RGB'):
     from torchvision import get_image_backend
-    if get_image_backend() == 'accimage':
+    if get_image_backend() == 'accimage' and mode == 'RGB':
         return accimage_loader(path)
     else:
-        return pil_loader(path)
+        return pil_loader(path, mode)
 
 class ImageDataset(data.Dataset):
 
@@ -53,13 +53,16 @@ class ImageDataset(data.Dataset):
                  meta_file,
                  transform=None,
                  image_size=128,
-                 normalize=True):
+                 normalize=True,
+                 mode='RGB'):
         self.root_dir = root_dir
+        # PIL mode of the loaded images, 'L' for single-channel (grayscale) images
+        self.mode = mode
         if transform is not None:
             self.transform = transform
         else:
-            norm_mean = [0.5, 0.5, 0.5]
-            norm_std = [0.5, 0.5, 0.5]
+            norm_mean = [0.5] * len(mode)
+            norm_std = [0.5] * len(mode)
             if normalize:
                 self.transform = transforms.Compose([
                     CenterCropLongEdge(),
@@ -78,14 +81,17 @@ class ImageDataset(data.Dataset):
         print("building dataset from %s" % meta_file)
         self.num = len(lines)
         self.metas = []
+        # optional third column: index of the PSF that degraded the image
+        self.psf_index = []
         self.classifier = None
         suffix =  ".JPEG"
         for line in lines:
             line_split = line.rstrip().split()
-            if len(line_split) == 2:
+            if len(line_split) >= 2:
                 self.metas.append((line_split[0] , int(line_split[1])))
             else:
                 self.metas.append((line_split[0] , -1))
+            self.psf_index.append(int(line_split[2]) if len(line_split) > 2 else 0)
         print("read meta done")
 
     def __len__(self):
@@ -100,7 +106,7 @@ class ImageDataset(data.Dataset):
         for ext in ['.jpg', '.JPEG', '.png']:
             filename = os.path.join(self.root_dir, base_filename + ext)
             if os.path.isfile(filename):
-                img = default_loader(filename)
+                img = default_loader(filename, self.mode)
                 break
         else:
             raise FileNotFoundError(f"No image found for {base_filename} with extensions .jpg, .JPEG, or .png")
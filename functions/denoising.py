@@ -1,3 +1,5 @@
+import logging
+import hashlib
 import torch
 from tqdm import tqdm
 import torchvision.utils as tvu
@@ -13,160 +15,556 @@ def compute_alpha(beta, t):
     return a
 
 
-def efficient_generalized_steps(x, seq, model, b, H_funcs, y_0, sigma_0, etaB, etaA, etaC, cls_fn=None, classes=None):
-    with torch.no_grad():
-        y_0 = y_0.reshape([x.shape[0],x.shape[1], x.shape[2], x.shape[3]])
-        # setup vectors used in the algorithm
-
-        singulars = H_funcs.singulars()
-        Sigma = torch.zeros(x.shape[1] * x.shape[2] * x.shape[3], dtype=singulars.dtype, device=x.device)
-        Sigma[:singulars.shape[0]] = singulars
-        U_t_y = H_funcs.Ut(y_0)
-        
-        # U_t_y = U_t_y.reshape(x.shape[0], -1)
-        Sig_inv_U_t_y = U_t_y / singulars[:U_t_y.shape[-1]]
+def step_scalars(sigma_next, etaA, etaC, dtype):
+    """
+    Per-step scalars of the DDRM update to the noise level sigma_next, in the precision of the
+    singulars: (sigma_next, std_nextA, sigma_tilde_nextA, std_nextC, sigma_tilde_nextC)
+    """
+    std_nextC = sigma_next * etaC
+    sigma_tilde_nextC = torch.sqrt(sigma_next ** 2 - std_nextC ** 2).to(dtype)
+    std_nextA = sigma_next * etaA
+    sigma_tilde_nextA = torch.sqrt(sigma_next ** 2 - std_nextA ** 2).to(dtype)
+    return sigma_next, std_nextA.to(dtype), sigma_tilde_nextA, std_nextC.to(dtype), sigma_tilde_nextC
+
+
+def ddrm_cases(Sigma, observed, sigma_next, sigma_0):
+    # noisier than y (before), less noisy than y (after), the others are missing
+    cond_before = Sigma * sigma_next > sigma_0
+    cond_after = Sigma * sigma_next < sigma_0
+    if observed is not None:
+        cond_after = cond_after & observed
+    missing = ~(cond_before | cond_after)
+    return cond_before, cond_after, missing
+
+
+def update_coeffs(Sigma, sigma_0, etaB):
+    """
+    The step-independent coefficient vectors of the DDRM update:
+    (etaB / Sigma, Sigma / sigma_0, etaB^2 sigma_0^2 / Sigma^2)
+    """
+    return etaB / Sigma, Sigma / sigma_0, sigma_0 ** 2 / Sigma ** 2 * (etaB ** 2)
+
+
+def accumulate(out, w, v):
+    # out += w * v in place, for real weights w of complex vectors too
+    if torch.is_complex(v) and not torch.is_complex(w):
+        torch.view_as_real(out).addcmul_(w.unsqueeze(-1), torch.view_as_real(v))
+    else:
+        out.addcmul_(w, v)
+
+
+def ddrm_update(V_t_x0, U_t_y, noise, V_t_et, cond_before, cond_after, coeffs, sigma_0, etaB, scalars):
+    """
+    The three DDRM cases as one update with per-coefficient weights, built from the cases, the
+    update_coeffs and the step_scalars inside the (fusable) elementwise update rather than stored:
+    Vt(x_next) = w_x0 * Vt(x0_t) + w_y * Ut(y) + w_et * Vt(et) + w_noise * noise.
+    V_t_et may be None on steps without missing coefficients. sigma_0 and the scalars are
+    scalars, or per-sample tensors broadcasting against the coefficients.
+    """
+    sigma_next, std_nextA, sigma_tilde_nextA, std_nextC, sigma_tilde_nextC = scalars
+    etaB_inv_Sigma, Sigma_over_sigma_0, noise_floor = coeffs
+
+    # each weight is accumulated as soon as it is built, in place and without complex temporaries
+    # (the uncompiled path has no fusion to rely on)
+    w = torch.where(cond_after, (Sigma_over_sigma_0 * -sigma_tilde_nextA).add_(1), 1.0)
+    Vt_xt_mod_next = w.masked_fill_(cond_before, 1 - etaB) * V_t_x0
+    w = torch.where(cond_before, etaB_inv_Sigma, torch.where(cond_after, sigma_tilde_nextA / sigma_0, 0.0))
+    accumulate(Vt_xt_mod_next, w, U_t_y)
+    w = torch.where(cond_before, (sigma_next ** 2 - noise_floor).sqrt_(), torch.where(cond_after, std_nextA, std_nextC))
+    accumulate(Vt_xt_mod_next, w, noise)
+    if V_t_et is not None:
+        accumulate(Vt_xt_mod_next, torch.where(cond_before | cond_after, 0.0, sigma_tilde_nextC), V_t_et)
+    return Vt_xt_mod_next
+
+
+def x0_extrapolation(b, t_prev, t, t_next):
+    """
+    DPM-Solver++(2M): x0 is extrapolated from the last two predictions as
+    x0_t + h / (2 h_prev) * (x0_t - x0_prev), h the step in half log-SNR. Returns the coefficient
+    h / (2 h_prev) of steps from the timesteps t (after t_prev) to t_next, in double precision.
+    It is 0 (first order) on first steps, t_prev < 0, and on the steps to t_next <= 0: the final one
+    ends at t = -1 (of infinite log-SNR) and the one to t = 0 is the last step of DPM-Solver, first
+    order there for stability.
+    """
+    lambdas = [0.5 * torch.log(a / (1 - a)).flatten().double()
+               for a in (compute_alpha(b, t_prev.long()), compute_alpha(b, t.long()), compute_alpha(b, t_next.long()))]
+    h_prev, h = lambdas[1] - lambdas[0], lambdas[2] - lambdas[1]
+    return torch.where((t_prev.flatten() >= 0) & (t_next.flatten() > 0), h / (2 * h_prev), 0.0)
+
+
+class SamplingPlan(object):
+    """
+    Everything of efficient_generalized_steps that only depends on the schedule (seq, b), the
+    compact singulars of the operator and (sigma_0, etaA, etaB, etaC): the per-step scalars, the
+    coefficient vectors of the initialization and of the update, and the case of every coefficient
+    at every step. sigma_next decreases along the steps, so a coefficient is 'before' up to a step
+    and 'after' from a later one: storing these two switch steps keeps the plan O(steps + D) and
+    leaves the sampling loop with integer comparisons and scalar broadcasts. Build it with
+    get_plan, which reuses it across batches and runs.
+    """
+
+    def __init__(self, seq, b, Sigma, observed, sigma_0, etaA, etaB, etaC):
+        self.Sigma = Sigma
+        self.observed = observed
+        seq_next = [-1] + list(seq[:-1])
+        self.steps = list(zip(reversed(seq), reversed(seq_next)))
 
         # initialize x_T as given in the paper
-        largest_alphas = compute_alpha(b, (torch.ones(x.size(0)) * seq[-1]).to(x.device).long())
-        largest_sigmas = (1 - largest_alphas).sqrt() / largest_alphas.sqrt()
-
-        if singulars.dtype == torch.complex128:
-            large_singulars_index = torch.where(torch.abs((singulars) * largest_sigmas[0, 0, 0, 0]) > sigma_0)
-        else:
-            large_singulars_index = torch.where(singulars * largest_sigmas[0, 0, 0, 0] > sigma_0)
-
-        inv_singulars_and_zero = torch.zeros(x.shape[1] * x.shape[2] * x.shape[3], dtype=singulars.dtype).to(
-            singulars.device)
-        inv_singulars_and_zero[large_singulars_index] = sigma_0 / singulars[large_singulars_index]
-
-        inv_singulars_and_zero = inv_singulars_and_zero.view(1, -1)
-
-        # implement p(x_T | x_0, y) as given in the paper
+        largest_alpha = compute_alpha(b, torch.tensor([seq[-1]], device=b.device).long())[0, 0, 0, 0]
+        self.largest_alpha = largest_alpha
+        self.largest_sigma = (1 - largest_alpha).sqrt() / largest_alpha.sqrt()
         # if eigenvalue is too small, we just treat it as zero (only for init)
-        init_y = torch.zeros(x.shape[0], x.shape[1] * x.shape[2] * x.shape[3]).to(x.device)
-        init_y = init_y.to(U_t_y.dtype)  # Ensure init_y has the same dtype as U_t_y
-        init_y[:, large_singulars_index[0]] = U_t_y[:, large_singulars_index[0]] / singulars[
-            large_singulars_index].reshape(1, -1)
-
-        init_y = init_y.reshape(x.shape[0], x.shape[1], x.shape[2], x.shape[3])
-        remaining_s = largest_sigmas.view(-1, 1) ** 2 - inv_singulars_and_zero ** 2
-
-        if remaining_s.dtype == torch.complex128:
-            real_part = remaining_s.real
-            imag_part = remaining_s.imag
-
-            # Apply clamp_min and sqrt on both parts
-            real_part = real_part.clamp_min(0.0)
-            imag_part = imag_part.clamp_min(0.0)
-
-            # Combine back into a complex tensor
-            #remaining_s = torch.abs(remaining_s).clamp_min(0.0)
-
-            remaining_s = remaining_s.view(x.shape[0], x.shape[1], x.shape[2], x.shape[3]).sqrt()
+        self.large_singulars = Sigma * self.largest_sigma > sigma_0
+        inv_singulars_and_zero = torch.where(self.large_singulars, sigma_0 / Sigma, torch.zeros_like(Sigma))
+        self.remaining_s = (self.largest_sigma ** 2 - inv_singulars_and_zero ** 2).clamp_min(0.0).sqrt()
+
+        # per-step scalars, all alphas at once
+        alphas = compute_alpha(b, torch.tensor([i for i, _ in self.steps], device=b.device).long())
+        alphas_next = compute_alpha(b, torch.tensor([j for _, j in self.steps], device=b.device).long())
+        self.at = list(alphas.split(1))
+        self.at_next = list(alphas_next.split(1))
+
+        # the scalars of the update of each step and the switch steps of the coefficients: they are
+        # 'before' on the steps < before_until and 'after' on the steps >= after_from
+        self.coeffs = update_coeffs(Sigma, sigma_0, etaB)
+        self.scalars = []
+        needs_et = []
+        before_steps, after_steps = 0, 0
+        sigmas_next = ((1 - alphas_next).sqrt() / alphas_next.sqrt()).flatten()
+        if (sigmas_next[1:] > sigmas_next[:-1]).any():
+            raise ValueError("the timesteps of a sampling plan must be increasing")
+        for sigma_next in sigmas_next:
+            self.scalars.append(step_scalars(sigma_next, etaA, etaC, Sigma.dtype))
+            cond_before, cond_after, missing = ddrm_cases(Sigma, observed, sigma_next, sigma_0)
+            before_steps = before_steps + cond_before.int()
+            after_steps = after_steps + cond_after.int()
+            # Vt(et) only enters the update on missing coefficients
+            needs_et.append(missing.any())
+        self.before_until = before_steps
+        self.after_from = len(self.steps) - after_steps
+        # the steps that need Vt(et), in a single sync
+        self.needs_et = torch.stack(needs_et).tolist()
+
+        # the coefficient of the DPM-Solver++(2M) extrapolation of x0 on each step
+        t_prev = torch.tensor([-1] + [i for i, _ in self.steps[:-1]], device=b.device)
+        self.x0_extrapolation = x0_extrapolation(b, t_prev, torch.tensor([i for i, _ in self.steps], device=b.device),
+                                                 torch.tensor([j for _, j in self.steps], device=b.device)).tolist()
+
+
+# sampling plans of this process, keyed by schedule (the contents of the betas), singulars and noise
+# levels (the plan keeps its singulars alive, so their address identifies them); the oldest ones
+# are evicted past _max_plans
+_plans = {}
+_max_plans = 8
+
+
+_compiled_update = None
+
+
+def compiled_update():
+    global _compiled_update
+    if _compiled_update is None:
+        _compiled_update = torch.compile(ddrm_update) if hasattr(torch, 'compile') else ddrm_update
+    return _compiled_update
+
+
+def get_plan(seq, b, H_funcs, sigma_0, etaA, etaB, etaC):
+    Sigma = H_funcs.singulars_compact()
+    observed = H_funcs.observed_compact()
+    betas_hash = hashlib.sha1(b.detach().cpu().numpy().tobytes()).hexdigest()
+    key = (tuple(seq), betas_hash, b.shape[0], b.dtype, str(b.device),
+           Sigma.data_ptr(), tuple(Sigma.shape), Sigma.dtype, str(Sigma.device),
+           None if observed is None else observed.data_ptr(), float(sigma_0), etaA, etaB, etaC)
+    if key not in _plans:
+        while len(_plans) >= _max_plans:
+            _plans.pop(next(iter(_plans)))
+        _plans[key] = SamplingPlan(seq, b, Sigma, observed, sigma_0, etaA, etaB, etaC)
+    return _plans[key]
+
+
+def predict_x0(xt, t, at, model, cls_fn=None, classes=None, model_channels=3):
+    """
+    UNet noise prediction et at xt (timesteps t, alphas at of shape (1 or B, 1, 1, 1)) and the
+    x0 prediction it implies. Returns x0_t and the et of the real part of xt.
+    """
+    n = xt.size(0)
+    # images with fewer channels than the UNet (e.g. grayscale) are replicated at its input
+    # and its output is averaged back, so everything else runs on the native channels
+    channels = xt.shape[1]
+
+    def to_model(v):
+        v = torch.real(v).to(dtype=torch.float32)
+        return v if channels == model_channels else v.repeat(1, model_channels // channels, 1, 1)
+
+    def from_model(e):
+        return e if channels == model_channels else e[:, :model_channels].mean(dim=1, keepdim=True)
+
+    # the real and imaginary parts of complex iterates go through the UNet as one 2B batch
+    if torch.is_complex(xt):
+        xt_in = torch.cat([to_model(xt), to_model(torch.imag(xt))])
+        t_in = torch.cat([t, t])
+        classes_in = None if classes is None else torch.cat([classes, classes])
+        at_in = at if at.size(0) == 1 else torch.cat([at, at])
+    else:
+        xt_in, t_in, classes_in, at_in = to_model(xt), t, classes, at
+
+    if cls_fn == None:
+        et = from_model(model(xt_in, t_in))
+    else:
+        et = from_model(model(xt_in, t_in, classes_in))
+        et = et[:, :3]
+        et = et - (1 - at_in).sqrt() * from_model(cls_fn(xt_in, t_in, classes_in))
+
+    if et.size(1) == 6:
+        et = et[:, :3]
+    et_final, et_imag = et[:n], et[n:]
+
+    x0_t = (torch.real(xt) - et_final.to(xt.dtype) * (1 - at).sqrt()) / at.sqrt()
+    if torch.is_complex(xt):
+        x0_t_imag = torch.real((torch.imag(xt) - et_imag.to(xt.dtype) * (1 - at).sqrt()) / at.sqrt())
+        x0_t = x0_t + 1j * x0_t_imag
+    return x0_t, et_final
+
+
+def x0_converged(x0_t, x0_prev, conv_tol):
+    # the samples whose x0 prediction changed by less than conv_tol (relative) over the step
+    change = (x0_t - x0_prev).flatten(1).norm(dim=1) / x0_t.flatten(1).norm(dim=1).clamp_min(1e-12)
+    return change < conv_tol
+
+
+def ddrm_transition(xt, Vt_xt, U_t_y, t, at, model, H_funcs, cases, coeffs, sigma_0, etaB, scalars, sqrt_at,
+                    sqrt_1m_at, sqrt_at_next, cls_fn=None, classes=None, model_channels=3, hermitian=False,
+                    update=ddrm_update, needs_et=True, V_t_x0_prev=None, extrapolation=0.0, noise_weights=None):
+    """
+    One DDRM step of xt (and Vt(xt)) at timesteps t, shared by generalized_steps_iter, with the
+    scalars of its plan, and ddrm_step, with per-sample tensors broadcasting against the V-space
+    vectors (sqrt(a_t), sqrt(1 - a_t), sqrt(a_next), sigma_0, the step_scalars and the dpmpp2m
+    extrapolation). cases are the (before, after) masks of the step. Vt(et) is only computed when
+    needs_et, x0 is extrapolated from V_t_x0_prev when it is given and the noise is scaled by the
+    operator's noise_weights (noise_compact()) when they are not None.
+    Returns the next xt and Vt(xt), x0_t, Vt(x0_t) (the next V_t_x0_prev) and the number of
+    non-finite V-space coefficients, which are sanitized.
+    """
+    n = xt.size(0)
+    coeff_shape = U_t_y.shape
+    x0_t, et_final = predict_x0(xt, t, at, model, cls_fn, classes, model_channels)
+
+    # variational inference conditioned on y, all 3 cases at once with a single noise draw
+    V_t_x0 = V_t_x0_pred = H_funcs.Vt(x0_t).reshape(coeff_shape)
+    if V_t_x0_prev is not None and not (isinstance(extrapolation, float) and extrapolation == 0):
+        V_t_x0 = V_t_x0 + extrapolation * (V_t_x0 - V_t_x0_prev)
+    # missing pixels
+    V_t_et = None
+    if needs_et:
+        if torch.is_complex(xt):
+            # the UNet only saw the parts of xt, which are not linear in Vt(xt)
+            V_t_et = H_funcs.Vt(et_final).reshape(coeff_shape)
+            if V_t_x0 is not V_t_x0_pred:
+                # the noise consistent with xt and the extrapolated x0
+                V_t_et = V_t_et - sqrt_at / sqrt_1m_at * (V_t_x0 - V_t_x0_pred)
+        else:
+            V_t_et = (Vt_xt - sqrt_at * V_t_x0) / sqrt_1m_at
+    noise = torch.randn_like(V_t_x0)
+    if noise_weights is not None:
+        noise.mul_(noise_weights)
+    Vt_xt_mod_next = update(V_t_x0, U_t_y, noise, V_t_et, cases[0], cases[1], coeffs, sigma_0, etaB, scalars)
+
+    # aggregate all 3 cases and give next prediction
+    nonfinite = (~torch.isfinite(Vt_xt_mod_next)).sum()
+    Vt_xt_mod_next.nan_to_num_(nan=0.0, posinf=1000, neginf=-1000)
+    if hermitian:
+        Vt_xt_mod_next = H_funcs.hermitian_part(Vt_xt_mod_next.reshape(n, -1)).reshape(coeff_shape)
+        xt_mod_next = torch.real(H_funcs.V(Vt_xt_mod_next.reshape(n, -1)))
+    else:
+        xt_mod_next = H_funcs.V(Vt_xt_mod_next.reshape(n, -1))
+    sqrt_at_next_img = sqrt_at_next if sqrt_at_next.dim() == 0 else sqrt_at_next.view(n, 1, 1, 1)
+    xt_next = sqrt_at_next_img * xt_mod_next.view(xt.shape)
+    return xt_next, sqrt_at_next * Vt_xt_mod_next, x0_t, V_t_x0_pred, nonfinite
+
+
+@torch.no_grad()
+def generalized_steps_iter(x, seq, model, b, H_funcs, y_0, sigma_0, etaB, etaA, etaC, cls_fn=None, classes=None,
+                           model_channels=3, hermitian=False, compile_update=False, stats=None, report_every=0,
+                           state=None, sampler='ddrm', warm_start=False, start_reg=0.0, conv_tol=0.0):
+    """
+    Generator version of efficient_generalized_steps: runs one step per iteration and yields
+    (step, t, x0_t), the step index, its timestep and the x0 prediction, for progressive previews.
+    The initial state and the current iterate are kept in state['x_T'] and state['xt'] when a
+    state dict is given.
+    """
+    # non-finite V-space coefficients are zeroed/clipped every step and counted on the device,
+    # without a sync: the count is added to stats['nonfinite'] (a tensor) and, with
+    # report_every > 0, logged every report_every steps.
+    # compile_update=True runs the fused V-space update through torch.compile.
+    # sampler='dpmpp2m' feeds the update a second-order (DPM-Solver++(2M)) multistep estimate of
+    # x0 instead of the current prediction; the measurement cases of the update are unchanged.
+    # It is exact for the deterministic part (eta = 0) and a heuristic otherwise.
+    # warm_start=True starts at seq[-1] from the pseudo inverse of y (regularized by start_reg) noised
+    # to that timestep, instead of pure noise, for schedules truncated at an intermediate t.
+    # conv_tol > 0 retires a sample once the relative change of its x0 prediction over a step falls
+    # below conv_tol: its x0_t is its output (as after DDRM's last step) and the later steps, UNet
+    # included, run on the remaining samples only. This costs one sync per step.
+    # hermitian=True keeps the V-space updates Hermitian, so that the iterates of complex
+    # (spectral) operators are exactly real and the UNet runs once per step, on xt alone.
+    if sampler not in ('ddrm', 'dpmpp2m'):
+        raise NotImplementedError(sampler)
+    y_0 = y_0.reshape(x.shape[0], -1)
+    # setup vectors used in the algorithm
+    plan = get_plan(seq, b, H_funcs, sigma_0, etaA, etaB, etaC)
+    update = compiled_update() if compile_update else ddrm_update
+
+    # V-space vectors are viewed as (Batch, *coeff_shape) and the singulars are kept compact
+    # (shared by the batch and/or the channels), so that all the mask math below broadcasts
+    n = x.size(0)
+    coeff_shape = (n,) + tuple(H_funcs.coeff_shape())
+    V_dim = int(np.prod(coeff_shape[1:]))
+    # the singular values are real and nonnegative (spectral operators fold their phase into U)
+    Sigma = plan.Sigma
+    U_t_y = H_funcs.add_zeros(H_funcs.Ut(y_0)).reshape(coeff_shape)
+    Sig_inv_U_t_y = U_t_y / Sigma
+    # coefficients beyond the small dimension (trailing zeros) are never observed
+    if plan.observed is not None:
+        Sig_inv_U_t_y = torch.where(plan.observed, Sig_inv_U_t_y, torch.zeros_like(Sig_inv_U_t_y))
+
+    # implement p(x_T | x_0, y) as given in the paper
+    if warm_start:
+        # the coefficients too noisy to take from y come from the regularized pseudo inverse
+        pinv_U_t_y = H_funcs.pinv_singulars(Sigma, start_reg) * U_t_y
+        if plan.observed is not None:
+            pinv_U_t_y = torch.where(plan.observed, pinv_U_t_y, torch.zeros_like(pinv_U_t_y))
+        init_y = torch.where(plan.large_singulars, Sig_inv_U_t_y, pinv_U_t_y)
+    else:
+        init_y = torch.where(plan.large_singulars, Sig_inv_U_t_y, torch.zeros_like(Sig_inv_U_t_y))
+
+    # reuse the given noise when V-space matches the image, otherwise draw it at the V-space size
+    if V_dim == x[0].numel():
+        x_T = x.reshape(coeff_shape)
+    else:
+        x_T = torch.randn(coeff_shape, device=x.device)
+    noise_weights = H_funcs.noise_compact()
+    if noise_weights is not None:
+        x_T = x_T * noise_weights
+    init_y = init_y + plan.remaining_s * x_T
+    if warm_start:
+        # exact x_t = sqrt(a_t) (x_0 + sigma_t noise): 1 / sigma_t is only close to sqrt(a_t) near T
+        init_y = init_y * plan.largest_alpha.sqrt()
+    else:
+        init_y = init_y / plan.largest_sigma
+    if hermitian:
+        init_y = H_funcs.hermitian_part(init_y.reshape(n, -1)).reshape(coeff_shape)
+
+    # setup iteration variables
+    x = H_funcs.V(init_y.reshape(n, -1)).view(x.shape[0], x.shape[1], x.shape[2], x.shape[3])
+    if hermitian:
+        x = torch.real(x)
+
+    xt = x
+    if state is not None:
+        state['x_T'] = x
+
+    # the iterate is also carried in V-space: the update gives Vt(xt) of the next step, so each
+    # step transforms x0_t forward and the update back, and Vt(et) follows by linearity
+    Vt_xt = init_y
+    V_t_x0_prev = None
+    nonfinite = torch.zeros((), dtype=torch.long, device=x.device)
+
+    # early exit: indices of the samples still running, and the full batch outputs
+    active = None
+    if conv_tol > 0:
+        n_full = n
+        active = torch.arange(n, device=x.device)
+        xt_full, x0_full, x0_prev = x, None, None
+
+    def rows(w):
+        # per-sample singulars (one PSF per image) follow the running samples
+        if active is None or w is None or w.dim() != len(coeff_shape) or w.shape[0] != n_full:
+            return w
+        return w.index_select(0, active)
+
+    coeffs_run, before_until, after_from = plan.coeffs, plan.before_until, plan.after_from
+
+    # iterate over the timesteps
+    for step, (i, j) in enumerate(tqdm(plan.steps)):
+        t = (torch.ones(n) * i).to(x.device)
+        at = plan.at[step]
+        at_next = plan.at_next[step]
+
+        xt_next, Vt_xt, x0_t, V_t_x0, nonfinite_step = ddrm_transition(
+            xt, Vt_xt, U_t_y, t, at, model, H_funcs, (before_until > step, after_from <= step), coeffs_run, sigma_0,
+            etaB, plan.scalars[step], at.sqrt()[0, 0, 0, 0], (1 - at).sqrt()[0, 0, 0, 0], at_next.sqrt()[0, 0, 0, 0],
+            cls_fn=cls_fn, classes=classes, model_channels=model_channels, hermitian=hermitian, update=update,
+            needs_et=plan.needs_et[step], V_t_x0_prev=V_t_x0_prev, extrapolation=plan.x0_extrapolation[step],
+            noise_weights=noise_weights)
+        if sampler == 'dpmpp2m':
+            V_t_x0_prev = V_t_x0
+        nonfinite += nonfinite_step
+        if report_every > 0 and (step + 1) % report_every == 0:
+            logging.info("step %d: %d non-finite coefficients so far" % (step + 1, nonfinite.item()))
+
+        xt = xt_next
+        if active is not None:
+            # outputs of the full batch, retired samples included (out of place: they are yielded)
+            xt_full = xt_full.index_copy(0, active, xt.to(xt_full.dtype))
+            if x0_full is None:
+                x0_full = x0_t.new_zeros((n_full,) + x0_t.shape[1:])
+            x0_full = x0_full.index_copy(0, active, x0_t)
+            if x0_prev is not None and step < len(plan.steps) - 1:
+                done = x0_converged(x0_t, x0_prev, conv_tol)
+                if done.any():
+                    xt_full = xt_full.index_copy(0, active[done], x0_t[done].to(xt_full.dtype))
+                    keep = ~done
+                    active, xt, Vt_xt, U_t_y, x0_t = active[keep], xt[keep], Vt_xt[keep], U_t_y[keep], x0_t[keep]
+                    if V_t_x0_prev is not None:
+                        V_t_x0_prev = V_t_x0_prev[keep]
+                    if classes is not None:
+                        classes = classes[keep]
+                    n = active.numel()
+                    coeffs_run = tuple(rows(w) for w in plan.coeffs)
+                    before_until, after_from = rows(plan.before_until), rows(plan.after_from)
+                    coeff_shape = (n,) + coeff_shape[1:]
+            x0_prev = x0_t
+        if state is not None:
+            state['xt'] = xt if active is None else xt_full
+        yield step, i, x0_t if active is None else x0_full
+        if active is not None and n == 0:
+            break
+
+    if stats is not None:
+        stats['nonfinite'] = stats.get('nonfinite', 0) + nonfinite
+        if active is not None:
+            stats['early_exit'] = stats.get('early_exit', 0) + n_full - n
+
+
+
+def efficient_generalized_steps(x, seq, model, b, H_funcs, y_0, sigma_0, etaB, etaA, etaC, cls_fn=None, classes=None,
+                                model_channels=3, hermitian=False, compile_update=False, stats=None, report_every=0,
+                                last_only=False, snapshot_stride=0, snapshot_dir=None, callback=None, sampler='ddrm',
+                                warm_start=False, start_reg=0.0, conv_tol=0.0):
+    # last_only=True keeps only the current state in xs and x0_preds, so memory does not grow
+    # with the number of steps; with snapshot_stride > 0, every snapshot_stride-th state is
+    # written to snapshot_dir as <step>.npz (xt and x0_t) instead.
+    # callback(step, t, x0_t) is called after every step (e.g. for previews).
+    state = {}
+    xs, x0_preds = [], []
+    for step, t, x0_t in generalized_steps_iter(x, seq, model, b, H_funcs, y_0, sigma_0, etaB, etaA, etaC,
+                                                cls_fn=cls_fn, classes=classes, model_channels=model_channels,
+                                                hermitian=hermitian, compile_update=compile_update, stats=stats,
+                                                report_every=report_every, state=state, sampler=sampler,
+                                                warm_start=warm_start, start_reg=start_reg, conv_tol=conv_tol):
+        if not xs:
+            xs.append(state['x_T'])
+        xt_next = state['xt']
+        if callback is not None:
+            callback(step, t, x0_t)
+
+        if snapshot_stride > 0 and (step + 1) % snapshot_stride == 0:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            np.savez(os.path.join(snapshot_dir, "%04d.npz" % (step + 1)),
+                     xt=xt_next.cpu().numpy(), x0_t=x0_t.cpu().numpy())
+
+        if last_only:
+            x0_preds = [x0_t]
+            xs = [xt_next]
         else:
-            remaining_s = remaining_s.view(x.shape[0], x.shape[1], x.shape[2], x.shape[3]).clamp_min(0.0).sqrt()
-
-        init_y = init_y + remaining_s * x
-        init_y = init_y / largest_sigmas
-
-        # setup iteration variables
-        x = H_funcs.V(init_y).view(x.shape[0], x.shape[1], x.shape[2], x.shape[3])
-
-        n = x.size(0)
-        seq_next = [-1] + list(seq[:-1])
-        x0_preds = []
-        xs = [x]
-
-        # iterate over the timesteps
-        for i, j in tqdm(zip(reversed(seq), reversed(seq_next))):
-            t = (torch.ones(n) * i).to(x.device)
-            next_t = (torch.ones(n) * j).to(x.device)
-            at = compute_alpha(b, t.long())
-            at_next = compute_alpha(b, next_t.long())
-
-            xt = xs[-1].to('cuda')
-            if cls_fn == None:
-                et_final = model(torch.real(xt).to(dtype=torch.float32), t)
-
-                if singulars.dtype == torch.complex128:
-                    et_imag = model(torch.imag(xt).to(dtype=torch.float32), t)
-            else:
-                et = model(torch.real(xt).to(dtype=torch.float32), t, classes)
-                et = et[:, :3]
-                et_final = et - (1 - at).sqrt()[0, 0, 0, 0] * cls_fn(torch.real(xt).to(dtype=torch.float32), t, classes)
-
-                if singulars.dtype == torch.complex128:
-                    et_imag = model(torch.imag(xt).to(dtype=torch.float32), t, classes)
-                    et_imag = et_imag[:, :3]
-                    et_imag = et_imag - (1 - at).sqrt()[0, 0, 0, 0] * cls_fn(torch.imag(xt).to(dtype=torch.float32), t,classes)
-
-
-            if et_final.size(1) == 6:
-                et_final = et_final[:, :3]
-                if singulars.dtype == torch.complex128:
-                    et_imag = et_imag[:, :3]
-
-            x0_t = (torch.real(xt) - et_final.to(xt.dtype) * (1 - at).sqrt()) / at.sqrt()
-            if singulars.dtype == torch.complex128:
-                x0_t_imag = torch.real((torch.imag(xt) - et_imag.to(xt.dtype) * (1 - at).sqrt()) / at.sqrt())
-                x0_t = x0_t + 1j * x0_t_imag
-
-            # variational inference conditioned on y
-            sigma = (1 - at).sqrt()[0, 0, 0, 0] / at.sqrt()[0, 0, 0, 0]
-            sigma_next = (1 - at_next).sqrt()[0, 0, 0, 0] / at_next.sqrt()[0, 0, 0, 0]
-            xt_mod = xt / at.sqrt()[0, 0, 0, 0]
-
-            V_t_x = H_funcs.Vt(xt_mod)
-            SVt_x = (V_t_x * Sigma)[:, :U_t_y.shape[1]]
-            V_t_x0 = H_funcs.Vt(x0_t)
-            SVt_x0 = (V_t_x0 * Sigma)[:, :U_t_y.shape[1]]
-
-            falses = torch.zeros(V_t_x0.shape[1] - singulars.shape[0], dtype=torch.bool, device=xt.device)
-
-            if singulars.dtype == torch.complex128:
-                cond_before_lite = torch.abs(singulars) > sigma_0/sigma_next
-                has_false_values = torch.any(~cond_before_lite)
-                cond_after_lite = torch.abs(singulars) < sigma_0/sigma_next
-
-            else:
-                cond_before_lite = singulars * sigma_next > sigma_0
-                cond_after_lite = singulars * sigma_next < sigma_0
-
-            cond_before = torch.hstack((cond_before_lite, falses))
-            cond_after = torch.hstack((cond_after_lite, falses))
-
-            std_nextC = sigma_next * etaC
-            sigma_tilde_nextC = torch.sqrt(sigma_next ** 2 - std_nextC ** 2)
-
-            std_nextA = sigma_next * etaA
-            sigma_tilde_nextA = torch.sqrt(sigma_next ** 2 - std_nextA ** 2)
-
-            diff_sigma_t_nextB = torch.sqrt(
-                sigma_next ** 2 - sigma_0 ** 2 / singulars[cond_before_lite] ** 2 * (etaB ** 2))
-
-            # missing pixels
-            Vt_xt_mod_next = V_t_x0 + sigma_tilde_nextC * H_funcs.Vt(et_final) + std_nextC * torch.randn_like(V_t_x0)
-
-            Vt_xt_mod_next[:, cond_after] = V_t_x0[:, cond_after] + sigma_tilde_nextA * ((U_t_y - SVt_x0) / sigma_0)[:,
-                                                                                        cond_after_lite] + std_nextA * torch.randn_like(
-                V_t_x0[:, cond_after])
-
-            # noisier than y (before)
-            Vt_xt_mod_next[:, cond_before] = \
-                (Sig_inv_U_t_y[:, cond_before_lite] * etaB + (1 - etaB) * V_t_x0[:,cond_before] + diff_sigma_t_nextB * torch.randn_like(
-                    U_t_y)[:, cond_before_lite])
-
-            # aggregate all 3 cases and give next prediction
-
-            if torch.isnan(Vt_xt_mod_next).any() or torch.isinf(Vt_xt_mod_next).any():
-
-                Vt_xt_mod_next = torch.nan_to_num(Vt_xt_mod_next, nan=0.0, posinf=1000, neginf=-1000)
-            xt_mod_next = H_funcs.V(
-                Vt_xt_mod_next.view(x.shape[0], x.shape[1], x.shape[2], x.shape[3]))
-
-            xt_next = (at_next.sqrt()[0, 0, 0, 0] * xt_mod_next).view(x.shape[0], x.shape[1], x.shape[2],x.shape[3])
-
             x0_preds.append(x0_t)
             xs.append(xt_next)
 
-    return xs, x0_preds
\ No newline at end of file
+    return xs, x0_preds
+
+
+# per-sample sampling, for continuous batching: every sample of the batch has its own timestep t,
+# next timestep t_next (-1 for the last step) and sigma_0, so that new samples can join a running
+# batch at step boundaries (their rows of xt, Vt_xt and U_t_y concatenated to the others, and the
+# operator set up for the new batch, e.g. with set_kernel_index). observed optionally restricts
+# the observed coefficients per sample (a boolean (B, *coeff_shape) mask). The cases and the
+# coefficient vectors are built every step, as there is no shared schedule to plan for.
+
+def per_sample(v, n, dtype, device, ndim):
+    # scalar or (B,) values as (B, 1, ..., 1) tensors of ndim dimensions
+    return torch.as_tensor(v, dtype=dtype, device=device).expand(n).reshape((n,) + (1,) * (ndim - 1))
+
+
+@torch.no_grad()
+def ddrm_init(x, t, b, H_funcs, y_0, sigma_0, hermitian=False, observed=None):
+    """
+    Initial state of samples joining at timesteps t (p(x_t | x_0, y) as given in the paper), from
+    the noise x. Returns xt and the V-space vectors Vt(xt) and Ut(y) that ddrm_step carries.
+    """
+    n = x.size(0)
+    coeff_shape = (n,) + tuple(H_funcs.coeff_shape())
+    Sigma = H_funcs.singulars_compact()
+    if observed is None:
+        observed = H_funcs.observed_compact()
+    sigma_0 = per_sample(sigma_0, n, Sigma.dtype, Sigma.device, len(coeff_shape))
+    at = compute_alpha(b, t.long())
+    largest_sigma = per_sample((1 - at).sqrt().flatten() / at.sqrt().flatten(), n, Sigma.dtype, Sigma.device,
+                               len(coeff_shape))
+
+    U_t_y = H_funcs.add_zeros(H_funcs.Ut(y_0.reshape(n, -1))).reshape(coeff_shape)
+    Sig_inv_U_t_y = U_t_y / Sigma
+    if observed is not None:
+        Sig_inv_U_t_y = torch.where(observed, Sig_inv_U_t_y, torch.zeros_like(Sig_inv_U_t_y))
+    large_singulars = Sigma * largest_sigma > sigma_0
+    init_y = torch.where(large_singulars, Sig_inv_U_t_y, torch.zeros_like(Sig_inv_U_t_y))
+    inv_singulars_and_zero = torch.where(large_singulars, sigma_0 / Sigma, torch.zeros_like(Sigma))
+    remaining_s = (largest_sigma ** 2 - inv_singulars_and_zero ** 2).clamp_min(0.0).sqrt()
+    if x[0].numel() == int(np.prod(coeff_shape[1:])):
+        x_T = x.reshape(coeff_shape)
+    else:
+        x_T = torch.randn(coeff_shape, device=x.device)
+    if H_funcs.noise_compact() is not None:
+        x_T = x_T * H_funcs.noise_compact()
+    # exact x_t = sqrt(a_t) (x_0 + sigma_t noise), as the samples may join at any t
+    init_y = (init_y + remaining_s * x_T) * per_sample(at.sqrt().flatten(), n, Sigma.dtype, Sigma.device,
+                                                      len(coeff_shape))
+    if hermitian:
+        init_y = H_funcs.hermitian_part(init_y.reshape(n, -1)).reshape(coeff_shape)
+    xt = H_funcs.V(init_y.reshape(n, -1)).view(x.shape)
+    if hermitian:
+        xt = torch.real(xt)
+    return xt, init_y, U_t_y
+
+
+@torch.no_grad()
+def ddrm_step(xt, Vt_xt, U_t_y, t, t_next, model, b, H_funcs, sigma_0, etaB, etaA, etaC, cls_fn=None,
+              classes=None, model_channels=3, hermitian=False, observed=None, stats=None, t_prev=None,
+              V_t_x0_prev=None):
+    """
+    One DDRM step of every sample from its timestep t to its t_next, each with its own sigma_0,
+    through the same ddrm_transition as generalized_steps_iter. Returns the next xt and Vt(xt),
+    the x0 prediction and its Vt. With t_prev (the previous timestep of each sample, -1 on its
+    first step) and V_t_x0_prev (the Vt(x0) returned by the previous step, zeros for new samples),
+    x0 is extrapolated as by sampler='dpmpp2m'. Samples are retired by the caller, e.g. when
+    x0_converged. As in generalized_steps_iter, the non-finite V-space coefficients are sanitized
+    and their count added to stats['nonfinite'].
+    """
+    n = xt.size(0)
+    coeff_shape = (n,) + tuple(H_funcs.coeff_shape())
+    Sigma = H_funcs.singulars_compact()
+    if observed is None:
+        observed = H_funcs.observed_compact()
+    at = compute_alpha(b, t.long())
+    at_next = compute_alpha(b, t_next.long())
+
+    # the per-sample scalars, shaped to broadcast against the V-space vectors
+    def scalars_of(v):
+        return per_sample(v.flatten(), n, Sigma.dtype, Sigma.device, len(coeff_shape))
+
+    sigma_0 = per_sample(sigma_0, n, Sigma.dtype, Sigma.device, len(coeff_shape))
+    sigma_next = scalars_of((1 - at_next).sqrt() / at_next.sqrt())
+    cond_before, cond_after, missing = ddrm_cases(Sigma, observed, sigma_next, sigma_0)
+    extrapolation = 0.0
+    if V_t_x0_prev is not None:
+        extrapolation = scalars_of(x0_extrapolation(b, t_prev, t, t_next))
+
+    # no shared plan: the cases and coefficients are built here, and whether the step needs Vt(et)
+    # costs a sync
+    xt_next, Vt_xt_next, x0_t, V_t_x0, nonfinite = ddrm_transition(
+        xt, Vt_xt, U_t_y, t, at, model, H_funcs, (cond_before, cond_after), update_coeffs(Sigma, sigma_0, etaB),
+        sigma_0, etaB, step_scalars(sigma_next, etaA, etaC, Sigma.dtype), scalars_of(at.sqrt()),
+        scalars_of((1 - at).sqrt()), scalars_of(at_next.sqrt()), cls_fn=cls_fn, classes=classes,
+        model_channels=model_channels, hermitian=hermitian, needs_et=bool(missing.any()), V_t_x0_prev=V_t_x0_prev,
+        extrapolation=extrapolation, noise_weights=H_funcs.noise_compact())
+    if stats is not None:
+        stats['nonfinite'] = stats.get('nonfinite', 0) + nonfinite
+    return xt_next, Vt_xt_next, x0_t, V_t_x0
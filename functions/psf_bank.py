@@ -0,0 +1,50 @@
+import os, glob
+import numpy as np
+import scipy.io
+
+# folders searched for PSF files (psf_*.mat holding a 'psf_ref' array), in order
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PSF_DIRS = [REPO_ROOT, os.path.join(REPO_ROOT, "functions")]
+
+
+def find_psfs(dirs=None):
+    """
+    Index of the available PSFs: maps each PSF name (the file name without
+    extension, e.g. psf_GT_0) to its file. Earlier folders take precedence.
+    """
+    index = {}
+    for folder in (PSF_DIRS if dirs is None else dirs):
+        for path in sorted(glob.glob(os.path.join(folder, "psf*.mat"))):
+            name = os.path.splitext(os.path.basename(path))[0]
+            index.setdefault(name, path)
+    return index
+
+
+def psf_path(name, dirs=None):
+    # accept plain file paths too, so configs may keep listing .mat files
+    if os.path.isfile(name):
+        return name
+    index = find_psfs(dirs)
+    if name not in index:
+        raise ValueError("unknown PSF {}, available: {}".format(name, ", ".join(sorted(index))))
+    return index[name]
+
+
+def load_psf(name, dirs=None):
+    return scipy.io.loadmat(psf_path(name, dirs))["psf_ref"]
+
+
+def cached_array(cachedir, name, compute):
+    """
+    Array <name>.npy of cachedir, computed by compute() and saved on first use, then
+    memory-mapped, so that later runs and worker processes share one copy of it. The map is
+    copy-on-write: writes stay private to the process.
+    """
+    path = os.path.join(cachedir, name + ".npy")
+    if not os.path.exists(path):
+        os.makedirs(cachedir, exist_ok=True)
+        # write under a private name first: concurrent workers never see a partial file
+        tmp_path = "{}.{}.tmp.npy".format(path[:-4], os.getpid())
+        np.save(tmp_path, np.ascontiguousarray(compute()))
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="c")
@@ -1,3 +1,4 @@
+import hashlib
 import torch
 import numpy as np
 
@@ -8,6 +9,21 @@ class H_functions:
     All output vectors are of shape (Batch, DataDimension).
     """
 
+    # Tikhonov regularizer of H_pinv (0 gives the plain pseudo inverse)
+    pinv_reg = 0.0
+
+    @staticmethod
+    def pinv_singulars(singulars, reg=0.0):
+        """
+        Singular values of the (Wiener/Tikhonov regularized) pseudo inverse:
+        conj(s) / (|s|^2 + reg), and 1 / s on the non-zero singulars when reg is 0
+        """
+        if reg > 0:
+            return singulars.conj() / (singulars.abs() ** 2 + reg)
+        nonzero = singulars != 0
+        return torch.where(nonzero, 1.0 / torch.where(nonzero, singulars, torch.ones_like(singulars)),
+                           torch.zeros_like(singulars))
+
     def V(self, vec):
         """
         Multiplies the input vector by V
@@ -44,20 +60,61 @@ class H_functions:
         """
         raise NotImplementedError()
 
+    def hermitian_part(self, vec):
+        """
+        Projects vectors of the big dimension (V) onto those that V maps to real vectors.
+        Operators with real V leave them unchanged
+        """
+        return vec
+
+    def coeff_shape(self):
+        """
+        Returns the shape (without the batch) under which vectors of the big dimension (V)
+        broadcast against singulars_compact(). By default V-space vectors stay flat
+        """
+        return (self.add_zeros(self.singulars().reshape(-1, self.singulars().shape[-1])).shape[1],)
+
+    def singulars_compact(self):
+        """
+        Returns the singular values in a compact form that broadcasts against V-space vectors
+        viewed as (Batch, *coeff_shape()), with a leading axis of 1 (shared by the batch) or Batch,
+        so that operators whose channels share their singulars need not repeat them.
+        Coefficients beyond the small dimension get a zero. The result should be the same tensor
+        across calls while the singulars do not change, as sampling plans are cached by it
+        """
+        if getattr(self, '_singulars_compact', None) is None:
+            singulars = self.singulars()
+            self._singulars_compact = self.add_zeros(singulars.reshape(-1, singulars.shape[-1]))
+        return self._singulars_compact
+
+    def noise_compact(self):
+        """
+        Returns per-coefficient weights of the sampler noise, broadcasting like singulars_compact(),
+        or None when every coefficient gets unit noise. Operators whose V uses a coefficient twice
+        (e.g. half spectra) scale its noise down to give the image the noise of the full operator
+        """
+        return None
+
+    def observed_compact(self):
+        """
+        Returns a mask, broadcasting like singulars_compact(), of the coefficients within the
+        small dimension (U), or None when there are no trailing zeros
+        """
+        if not hasattr(self, '_observed_compact'):
+            singulars = self.singulars()
+            if self.coeff_shape() == (singulars.shape[-1],):
+                self._observed_compact = None
+            else:
+                self._observed_compact = self.add_zeros(torch.ones(1, singulars.shape[-1], device=singulars.device)) != 0
+        return self._observed_compact
+
     def H(self, vec):
         """
         Multiplies the input vector by H
         """
         temp = self.Vt(vec)
         singulars = self.singulars()
-        output = self.U(singulars * temp[:, :singulars.shape[0]])
-        print('singulars',singulars)
-        print('temp',temp)
-        import scipy.io
-        scipy.io.savemat('H_values.mat',
-                         {'Vt': temp.detach().cpu().numpy(), 'singulars': singulars.detach().cpu().numpy(),
-                          'output': output.detach().cpu().numpy()})
-        return output
+        return self.U(singulars * temp[:, :singulars.shape[0]])
 
     def Ht(self, vec):
         """
@@ -67,24 +124,15 @@ class H_functions:
         singulars = self.singulars()
         return self.V(self.add_zeros(singulars * temp[:, :singulars.shape[0]]))
 
-    def H_pinv(self, vec):
+    def H_pinv(self, vec, reg=None):
         """
-        Multiplies the input vector by the pseudo inverse of H
+        Multiplies the input vector by the pseudo inverse of H, Tikhonov regularized
+        by reg (pinv_reg by default)
         """
         temp = self.Ut(vec)
         singulars = self.singulars()
-        inv_singulars = torch.where(singulars != 0, 1.0 / singulars, torch.tensor(float('inf')))
-
-        # Replace any infinities with a large value (e.g., 1000)
-        inv_singulars = torch.where(torch.isinf(inv_singulars), torch.tensor(1000.0), inv_singulars)
-
+        inv_singulars = self.pinv_singulars(singulars, self.pinv_reg if reg is None else reg)
         temp[:, :singulars.shape[0]] = temp[:, :singulars.shape[0]] * inv_singulars
-        output = self.V(self.add_zeros(temp))
-        import scipy.io
-        scipy.io.savemat('H_values.mat',
-                         {'Vt': temp.detach().cpu().numpy(), 'singulars': inv_singulars.detach().cpu().numpy(),
-                          'output': output.detach().cpu().numpy()})
-        
         return self.V(self.add_zeros(temp))
 
 
@@ -190,244 +238,474 @@ class Denoising(H_functions):
     def add_zeros(self, vec):
         return vec.clone().reshape(vec.shape[0], -1)
         
+# PSF spectra (with their magnitude and phase) shared by every BCCB operator built in this
+# process, keyed by (kernel hash, image dimension, spectral dimension, dtype, device)
+_psf_spectra = {}
+
+
+def psf_factors(kernel, dim, dtype=torch.complex128, device='cpu', cachedir=None, real_fft=False):
+    """
+    Returns the 2D FFT S of the kernel zero-padded to dim x dim and circularly shifted so that
+    its center sits at the origin, i.e. the eigenvalues of the BCCB matrix, with its magnitude
+    |S| and phase S / |S| (1 where S is 0), each dim x spectral_dim (the Hermitian half with
+    real_fft). Results are cached per process and, with cachedir, persisted in the PSF cache of
+    functions.psf_bank and memory-mapped from it, so that CPU runs and workers share one copy.
+    """
+    if isinstance(kernel, torch.Tensor):
+        kernel = kernel.detach().cpu().numpy()
+    kernel = np.ascontiguousarray(kernel, dtype=np.float64)
+    digest = hashlib.sha1(kernel.tobytes() + str(kernel.shape).encode()).hexdigest()
+    spectral_dim = dim // 2 + 1 if real_fft else dim
+    key = (digest, dim, spectral_dim, dtype, str(torch.device(device)))
+    if key in _psf_spectra:
+        return _psf_spectra[key]
+
+    def spectrum():
+        Mh, Nh = kernel.shape
+        center = (Mh // 2, Nh // 2)
+        padded = torch.zeros(dim, dim, dtype=torch.float64)
+        padded[:Mh, :Nh] = torch.from_numpy(kernel)
+        shifted = torch.roll(padded, shifts=(-center[0], -center[1]), dims=(0, 1))
+        return torch.fft.fft2(shifted)[:, :spectral_dim].to(dtype).contiguous()
+
+    def phase(S, magnitude):
+        nonzero = magnitude > 0
+        return torch.where(nonzero, S / torch.where(nonzero, magnitude, torch.ones_like(magnitude)),
+                           torch.ones_like(S))
+
+    if cachedir is None:
+        S = spectrum()
+        magnitude = S.abs()
+        factors = (S, magnitude, phase(S, magnitude))
+    else:
+        from functions.psf_bank import cached_array
+        name = "{}_{}_{}_{}".format(digest[:16], dim, spectral_dim, str(dtype).split('.')[-1])
+        S = torch.from_numpy(cached_array(cachedir, name + "_spectrum", lambda: spectrum().numpy()))
+        magnitude = torch.from_numpy(cached_array(cachedir, name + "_magnitude", lambda: S.abs().numpy()))
+        factors = (S, magnitude, torch.from_numpy(cached_array(cachedir, name + "_phase",
+                                                               lambda: phase(S, magnitude).numpy())))
+    # on the CPU (and in the cached dtype) this keeps the memory maps themselves
+    _psf_spectra[key] = tuple(f.to(device) for f in factors)
+    return _psf_spectra[key]
+
+
+# BCCB deconvolution: V = IFFT2 and the singulars are the magnitude |S| of the spectrum S of
+# the PSF, whose phase is folded into U = IFFT2(phase * .), so the singulars are real and nonnegative.
+# With real_fft=True the PSF is assumed real and only its Hermitian half spectrum
+# (dim x (dim // 2 + 1)) is kept, so V-space vectors are shorter than the image.
+# dtype selects the spectral precision (complex128, or complex64 for speed).
+# A list (or 3D stack) of PSFs keeps one spectrum per PSF; set_kernel_index then picks the PSF
+# of every sample, and singulars() returns one row of singular values per sample.
+# The channels share the spectrum, so singulars_compact() is its magnitude alone;
+# channels=1 restores grayscale images without tripling the spectral work.
+# cachedir points psf_factors to the persisted spectra of functions.psf_bank; a single PSF then
+# uses the memory-mapped arrays without copies (a stack of PSFs is gathered into private ones).
 class deconvolution_BCCB(H_functions):
-    def __init__(self, kernel, dim, device):
+    def __init__(self, kernel, dim, device, real_fft=False, dtype=torch.complex128, cachedir=None, channels=3):
         self.kernel = kernel
+        self.kernels = list(kernel) if isinstance(kernel, (list, tuple)) or kernel.ndim == 3 else [kernel]
         self.device = device
-        self.channels = 3
+        self.channels = channels
         self.dim = dim
-
-    def to_tensor(self, vec):
-        # Convert to tensor if it's a numpy array
-        if isinstance(vec, np.ndarray):
-            if np.iscomplexobj(vec):
-                return torch.tensor(vec, dtype=torch.complex128, device=self.device)
-            else:
-                return torch.tensor(vec, dtype=torch.float32, device=self.device)  # Move to specified device
-        print('isinstance:', isinstance(vec, np.ndarray))
-        print(vec.dtype)
-        return vec.to(self.device)  # Already a tensor, move to specified device
-
-    def to_numpy(self, vec):
-        # Convert to numpy array if it's a tensor
-        if isinstance(vec, torch.Tensor):
-            return vec.cpu().numpy()  # Move to CPU and convert to numpy
-        return vec  # Already a numpy array
+        self.real_fft = real_fft
+        self.dtype = dtype
+        self.real_dtype = torch.float32 if dtype == torch.complex64 else torch.float64
+        self.spectral_dim = dim // 2 + 1 if real_fft else dim
+        # the spectra only depend on the kernels, so compute (or look them up) once
+        factors = [psf_factors(k, dim, dtype, device, cachedir, real_fft) for k in self.kernels]
+        if len(factors) == 1:
+            self.spectra, self.magnitudes, self.phases = [f.unsqueeze(0) for f in factors[0]]
+        else:
+            self.spectra, self.magnitudes, self.phases = [torch.stack(f) for f in zip(*factors)]
+        self.set_kernel_index(None)
+        # irfft2 also uses the columns 0 < k2 < dim / 2 of a half spectrum for their conjugate
+        # mirror columns, where the full spectrum only keeps (X(k) + conj(X(-k))) / 2 in the real
+        # part: their noise is scaled by 1 / sqrt(2) so that the noise variance is the same
+        self._noise_compact = None
+        if real_fft:
+            k2 = torch.arange(self.spectral_dim, device=device)
+            paired = (k2 > 0) & (2 * k2 != dim)
+            weights = torch.where(paired, 0.5 ** 0.5, 1.0).to(self.real_dtype)
+            self._noise_compact = weights.repeat(dim).reshape(1, 1, dim * self.spectral_dim)
+
+    def set_kernel_index(self, index):
+        """
+        Selects the PSF of each sample of the following batches (a sequence of indices into
+        the kernels), or a single PSF shared by the whole batch when index is None
+        """
+        if index is None:
+            index = 0
+        else:
+            index = torch.as_tensor(index, device=self.spectra.device).long()
+        self.spectrum = self.spectra[index]
+        self.magnitude = self.magnitudes[index]
+        self.phase = self.phases[index]
+
+    def planes(self, spectrum):
+        # broadcasts a spectrum (or one per sample) against (batch, channel, dim, spectral_dim) planes
+        return spectrum.unsqueeze(1) if spectrum.dim() == 3 else spectrum
+
+    def fft2(self, vec):
+        # batched 2D FFT over every (batch, channel) plane at once, on the input's device
+        temp = vec.reshape(vec.shape[0], self.channels, self.dim, self.dim)
+        if self.real_fft:
+            return torch.fft.rfft2(torch.real(temp).to(self.real_dtype)).reshape(vec.shape[0], -1)
+        return torch.fft.fft2(temp.to(self.dtype)).reshape(vec.shape[0], -1)
+
+    def ifft2(self, vec):
+        # batched 2D inverse FFT over every (batch, channel) plane at once
+        temp = vec.reshape(vec.shape[0], self.channels, self.dim, self.spectral_dim).to(self.dtype)
+        if self.real_fft:
+            return torch.fft.irfft2(temp, s=(self.dim, self.dim)).reshape(vec.shape[0], -1)
+        return torch.fft.ifft2(temp).reshape(vec.shape[0], -1)
 
     def V(self, vec):
-        # Ensure vec is a tensor
-        # vec = self.to_tensor(vec)
-
-        # Apply IFFT2 on each channel separately for each batch
-        ifft_result = np.zeros_like(self.to_numpy(vec), dtype=np.complex128)
-
-        for b in range(vec.shape[0]):  # Loop over each batch
-            for c in range(self.channels):  # Loop over each channel
-                # Apply IFFT2 on each 2D channel
-                ifft_result[b, c, :, :] = np.fft.ifft2(self.to_numpy(vec)[b, c, :, :])
-        
-        ifft_result = self.to_tensor(ifft_result)
-        # Colomn wise vectorization
-        return ifft_result.reshape(vec.shape[0],-1)
+        return self.ifft2(vec)
 
     def Vt(self, vec):
-        # Ensure vec is a tensor
-        # vec = self.to_tensor(vec)
-
-        # Apply IFFT2 on each channel separately for each batch
-        fft_result = np.zeros_like(self.to_numpy(vec), dtype=np.complex128)
-
-        for b in range(vec.shape[0]):  # Loop over each batch
-            for c in range(self.channels):  # Loop over each channel
-                # Apply IFFT2 on each 2D channel
-                fft_result[b, c, :, :] = np.fft.fft2(self.to_numpy(vec)[b, c, :, :])
-        
-        fft_result = self.to_tensor(fft_result)
-
-        # Colomn wise vectorization
-        return fft_result.reshape(vec.shape[0],-1)
+        return self.fft2(vec)
 
     def U(self, vec):
-        # Ensure vec is a tensor
-        # vec = self.to_tensor(vec)
-
-        # Apply IFFT2 on each channel separately for each batch
-        ifft_result = np.zeros_like(self.to_numpy(vec), dtype=np.complex128)
-
-        for b in range(vec.shape[0]):  # Loop over each batch
-            for c in range(self.channels):  # Loop over each channel
-                # Apply IFFT2 on each 2D channel
-                ifft_result[b, c, :, :] = np.fft.ifft2(self.to_numpy(vec)[b, c, :, :])
-        
-        ifft_result = self.to_tensor(ifft_result)
-                # Colomn wise vectorization
-        return ifft_result.reshape(vec.shape[0], -1)
+        temp = vec.reshape(vec.shape[0], self.channels, self.dim, self.spectral_dim)
+        return self.ifft2(temp * self.planes(self.phase))
 
     def Ut(self, vec):
-        # Ensure vec is a tensor
-        # vec = self.to_tensor(vec)
+        temp = self.fft2(vec).reshape(vec.shape[0], self.channels, self.dim, self.spectral_dim)
+        return (temp * self.planes(self.phase).conj()).reshape(vec.shape[0], -1)
 
-        # Apply IFFT2 on each channel separately for each batch
-        fft_result = np.zeros_like(self.to_numpy(vec), dtype=np.complex128)
+    def singulars(self):
+        # (C * dim * spectral_dim,), or one such row per sample
+        magnitude = self.magnitude.reshape(-1, 1, self.dim * self.spectral_dim)
+        singulars = magnitude.expand(-1, self.channels, -1).reshape(magnitude.shape[0], -1)
+        return singulars if self.magnitude.dim() == 3 else singulars[0]
 
-        for b in range(vec.shape[0]):  # Loop over each batch
-            for c in range(self.channels):  # Loop over each channel
-                # Apply IFFT2 on each 2D channel
-                fft_result[b, c, :, :] = np.fft.fft2(self.to_numpy(vec)[b, c, :, :])
-        
-        fft_result = self.to_tensor(fft_result)
-                # Colomn wise vectorization
-        return fft_result.reshape(vec.shape[0], -1)
+    def coeff_shape(self):
+        return (self.channels, self.dim * self.spectral_dim)
 
-    def singulars(self):
+    def singulars_compact(self):
+        return self.magnitude.reshape(-1, 1, self.dim * self.spectral_dim)
 
-        # Calculate singular values and return as tensor on the specified device
-        Mh, Nh = self.kernel.shape
+    def observed_compact(self):
+        return None
 
-        # Calculate the center
-        center = np.floor(np.array([Mh, Nh]) / 2).astype(int)
+    def noise_compact(self):
+        return self._noise_compact
 
-        padded_hest = np.pad(self.kernel, ((0, self.dim - Mh), (0, self.dim - Nh)), mode='constant')
-        shifted_hest = np.roll(padded_hest, - center, axis=(0, 1))
+    def add_zeros(self, vec):
+        # U and V span the same (possibly half) spectrum, so there is nothing to pad
+        return vec.clone().reshape(vec.shape[0], -1)
 
-        # Applying 2D FFT and take the real part
-        sing_values = (torch.tensor((np.fft.fft2(shifted_hest)), device='cuda'))
-        sing_values = sing_values.unsqueeze(2).expand(-1, -1, self.channels).permute(2, 0, 1) # [C,H,W]
+    def hermitian_part(self, vec):
+        # (X(k) + conj(X(-k))) / 2, the spectrum of the real part; half spectra are real already
+        if self.real_fft:
+            return vec
+        temp = vec.reshape(vec.shape[0], self.channels, self.dim, self.dim)
+        mirrored = torch.roll(torch.flip(temp, dims=(2, 3)), shifts=(1, 1), dims=(2, 3)).conj()
+        return ((temp + mirrored) / 2).reshape(vec.shape[0], -1)
 
-        return sing_values.reshape(-1)
+    def filter(self, vec, spectrum):
+        """
+        FFT -> multiply by a (per-sample) spectrum -> inverse FFT, in a single pass:
+        the product is taken in place on the (batch, channel) planes of the transform
+        """
+        temp = self.fft2(vec).reshape(vec.shape[0], self.channels, self.dim, self.spectral_dim)
+        temp.mul_(self.planes(spectrum))
+        return self.ifft2(temp)
 
     def H(self, vec):
         """
         Multiplies the input vector by H
         """
-        temp = self.Vt(vec)
-        singulars = self.singulars()
-        S_Vt = (singulars * temp[:, :singulars.shape[0]]).reshape(vec.shape[0],self.channels,self.dim, self.dim)
-        output = self.U(S_Vt)
-        return output
+        return self.filter(vec, self.spectrum)
 
     def Ht(self, vec):
         """
-        Multiplies the input vector by H transposed
+        Multiplies the input vector by H transposed (the adjoint filter conj(spectrum))
         """
-        temp = self.Ut(vec)
-        singulars = self.singulars()
-        output = self.V(self.add_zeros(singulars * temp[:, :singulars.shape[0]]))
-        return output
-        
-    def H_pinv(self, vec):
+        return self.filter(vec, self.spectrum.conj())
+
+    def H_pinv(self, vec, reg=None):
         """
-        Multiplies the input vector by the pseudo inverse of H
+        Multiplies the input vector by the pseudo inverse of H, Wiener (Tikhonov)
+        regularized by reg (pinv_reg by default)
         """
-        temp = self.Ut(vec)
-        singulars = self.singulars()
-        inv_singulars = torch.where(singulars != 0, 1.0 / singulars, torch.tensor(float('inf')))
+        return self.filter(vec, self.pinv_singulars(self.spectrum, self.pinv_reg if reg is None else reg))
 
-        # Replace any infinities with a large value (e.g., 1000)
-        inv_singulars = torch.where(torch.isinf(inv_singulars), torch.tensor(1000.0), inv_singulars)
 
-        temp[:, :singulars.shape[0]] = (temp[:, :singulars.shape[0]] * inv_singulars)
-        temp = temp.view(vec.shape[0],self.channels,self.dim, self.dim)
-        output = self.V(temp)
+def rank1_svd(kernel):
+    """
+    Rank-1 SVD term of the PSF, as (kernel_col, kernel_row) with kernel ~ outer(kernel_col, kernel_row),
+    and the relative energy it leaves out (0 for separable PSFs)
+    """
+    if isinstance(kernel, torch.Tensor):
+        kernel = kernel.detach().cpu().numpy()
+    kernel = torch.from_numpy(np.ascontiguousarray(kernel, dtype=np.float64))
+    u, s, vt = torch.linalg.svd(kernel)
+    residual = torch.sqrt((s[1:] ** 2).sum() / (s ** 2).sum()).item() if s[0] > 0 else float('inf')
+    return (u[:, 0] * s[0].sqrt(), vt[0] * s[0].sqrt()), residual
 
-        
-        return self.V(temp)
 
+def separable_factors(kernel, tol=1e-6):
+    """
+    Returns (kernel_col, kernel_row) such that kernel ~ outer(kernel_col, kernel_row) when the
+    relative energy left out of the rank-1 SVD approximation of the PSF is at most tol, else None
+    """
+    if tol is None or tol < 0:
+        return None
+    factors, residual = rank1_svd(kernel)
+    return factors if residual <= tol else None
 
-class deconvolution_BCCB_br(H_functions):
 
+def conv_matrix(kernel, dim, boundary='circular', device='cpu', dtype=torch.float64):
+    """
+    Builds the dim x dim matrix of a 1D convolution by a kernel centred at len(kernel) // 2,
+    with 'circular', 'zero' or 'reflexive' boundaries
+    """
+    H = torch.zeros(dim, dim, dtype=dtype, device=device)
+    center = kernel.shape[0] // 2
+    for i in range(dim):
+        for j in range(kernel.shape[0]):
+            col = i - j + center
+            if boundary == 'circular':
+                col = col % dim
+            elif boundary == 'reflexive':
+                if col < 0: col = -col - 1
+                if col >= dim: col = 2 * dim - col - 1
+            if col < 0 or col >= dim:
+                continue
+            H[i, col] += kernel[j]
+    return H
+
+
+def blur_column(kernel, dim, boundary='circular', index=(0, 0)):
+    """
+    Blurs the unit image at pixel index with a 2D kernel centred at its shape // 2 (a column of
+    the blur matrix, as a dim x dim image), with the boundaries of conv_matrix
+    """
+    kernel = torch.as_tensor(np.asarray(kernel, dtype=np.float64))
+    column = torch.zeros(dim, dim, dtype=torch.float64)
+    for j in range(kernel.shape[0]):
+        tap = torch.zeros(kernel.shape[0], dtype=torch.float64)
+        tap[j] = 1
+        column += torch.outer(conv_matrix(tap, dim, boundary)[:, index[0]],
+                              conv_matrix(kernel[j], dim, boundary)[:, index[1]])
+    return column
 
-    def __init__(self, kernel, U, S, V, device):
-        self.kernel = kernel
-        self._U = torch.tensor(U,dtype=torch.float32, device = device)
-        self._singulars = torch.tensor(S,dtype=torch.float32, device = device)
-        self._V = torch.tensor(V,dtype=torch.float32, device = device)
-        self._Vt = self._V.transpose(0, 1)
-        self._Ut = self._U.transpose(0, 1)
 
-        self.device = device
-        self.channels = 3
-        self.dim = 128
+def blur_matrix(kernel, dim, boundary='circular'):
+    """
+    The dense (dim^2, dim^2) matrix of a 2D blur, for row-major images: the sum over the kernel
+    rows of Kronecker products of the 1D conv_matrix of a single tap and of the row
+    """
+    kernel = torch.as_tensor(np.asarray(kernel, dtype=np.float64))
+    H = torch.zeros(dim ** 2, dim ** 2, dtype=torch.float64)
+    for j in range(kernel.shape[0]):
+        tap = torch.zeros(kernel.shape[0], dtype=torch.float64)
+        tap[j] = 1
+        H += torch.kron(conv_matrix(tap, dim, boundary), conv_matrix(kernel[j], dim, boundary))
+    return H
 
-        ZERO = 1e-3
-        self._singulars[self._singulars < ZERO] = 0
-        
-        
-    def mat_by_vec(self, M, v):
-        vshape = v.shape[1]
-        if len(v.shape) > 2: vshape = vshape * v.shape[2]
-        if len(v.shape) > 3: vshape = vshape * v.shape[3]
-        return torch.matmul(M, v.view(v.shape[0], vshape,1)).view(v.shape[0], M.shape[0])
 
-    def V(self, vec):
-        vec = vec.reshape(1,3,128,128)
-        results = []
-        for channel in range(self.channels):
-            v_channel = vec[:, channel, :, :]  # Shape (N, H, W)
-            v_channel_reshaped = v_channel.view(vec.shape[0], -1)  # Shape (N, H*W)
-            # Apply mat_by_vec to the reshaped channel
-            result_channel = self.mat_by_vec(self._V, v_channel_reshaped)  # Shape (N, M.shape[0])
-            results.append(result_channel)
+def dct_matrix(dim):
+    # the orthonormal DCT-II matrix, one basis vector per row
+    n = torch.arange(dim, dtype=torch.float64)
+    C = torch.cos(np.pi * n.view(-1, 1) * (2 * n.view(1, -1) + 1) / (2 * dim)) * np.sqrt(2.0 / dim)
+    C[0] /= np.sqrt(2.0)
+    return C
 
-            # Stack the results to maintain the channel dimension
-        output = torch.stack(results, dim=1)  # Shape (N, C, M.shape[0])
 
-        return output.reshape(vec.shape[0], -1)  # Return the output in the shape (N, C * M.shape[0])
+def symmetric_psf(kernel, tol=1e-6):
+    """
+    Whether the PSF is symmetric about its centre along both axes (odd sizes, and the kernel equal
+    to its flips within tol of its largest entry)
+    """
+    kernel = np.asarray(kernel.detach().cpu() if isinstance(kernel, torch.Tensor) else kernel, dtype=np.float64)
+    if kernel.shape[0] % 2 == 0 or kernel.shape[1] % 2 == 0:
+        return False
+    scale = np.abs(kernel).max()
+    return bool(np.abs(kernel - kernel[::-1]).max() <= tol * scale and np.abs(kernel - kernel[:, ::-1]).max() <= tol * scale)
+
+
+# Separable deconvolution: a PSF kernel_col x kernel_row blurs with H_col (x) H_row, so its SVD is
+# the Kronecker product of two dim x dim SVDs, applied as one small matrix product per axis.
+# With circular boundaries this is the same operator as deconvolution_BCCB, but with real
+# factors and real singulars |fft(kernel_col)| x |fft(kernel_row)|. Singulars below ZERO are zeroed.
+class deconvolution_separable(H_functions):
+    def mat_by_img(self, M, v):
+        return torch.matmul(M, v.reshape(v.shape[0] * self.channels, self.dim,
+                                         self.dim)).reshape(v.shape[0], self.channels, M.shape[0], self.dim)
 
-        return self.mat_by_vec(self._V, vec.clone())
+    def img_by_mat(self, v, M):
+        return torch.matmul(v.reshape(v.shape[0] * self.channels, self.dim,
+                                      self.dim), M).reshape(v.shape[0], self.channels, self.dim, M.shape[1])
 
-    def Vt(self, vec):
-        vec = vec.reshape(1,3,128,128)
-        results = []
-        for channel in range(self.channels):
-            v_channel = vec[:, channel, :, :]  # Shape (N, H, W)
-            v_channel_reshaped = v_channel.view(vec.shape[0], -1)  # Shape (N, H*W)
-            # Apply mat_by_vec to the reshaped channel
-            result_channel = self.mat_by_vec(self._Vt, v_channel_reshaped)  # Shape (N, M.shape[0])
-            results.append(result_channel)
+    def __init__(self, kernel_col, kernel_row, channels, dim, device, boundary='circular', dtype=torch.float32, ZERO=0):
+        self.channels = channels
+        self.dim = dim
+        self.device = device
+        self.dtype = dtype
+        # get the svd of the 1D conv along each axis (in double precision, then cast)
+        H_col = conv_matrix(kernel_col, dim, boundary)
+        H_row = conv_matrix(kernel_row, dim, boundary)
+        U_col, singulars_col, V_col = torch.svd(H_col, some=False)
+        U_row, singulars_row, V_row = torch.svd(H_row, some=False)
+        self.U_col, self.V_col = U_col.to(device, dtype), V_col.to(device, dtype)
+        self.U_row, self.V_row = U_row.to(device, dtype), V_row.to(device, dtype)
+        # the singular values of the big matrix are exactly the outer product of the small ones
+        singulars = torch.outer(singulars_col, singulars_row).to(device, dtype)
+        singulars[singulars < ZERO] = 0
+        self._singulars = singulars.reshape(-1)
 
-            # Stack the results to maintain the channel dimension
-        output = torch.stack(results, dim=1)  # Shape (N, C, M.shape[0])
+    def V(self, vec):
+        # multiply the image by V_col from the left and by V_row^T from the right
+        temp = self.mat_by_img(self.V_col, vec.to(self.dtype))
+        return self.img_by_mat(temp, self.V_row.transpose(0, 1)).reshape(vec.shape[0], -1)
 
-        return output.reshape(vec.shape[0], -1)  # Return the output in the shape (N, C * M.shape[0])
+    def Vt(self, vec):
+        # multiply the image by V_col^T from the left and by V_row from the right
+        temp = self.mat_by_img(self.V_col.transpose(0, 1), vec.to(self.dtype))
+        return self.img_by_mat(temp, self.V_row).reshape(vec.shape[0], -1)
 
     def U(self, vec):
-        vec = vec.reshape(1,3,128,128)
-        results = []
-        for channel in range(self.channels):
-            v_channel = vec[:, channel, :, :]  # Shape (N, H, W)
-            v_channel_reshaped = v_channel.view(vec.shape[0], -1)  # Shape (N, H*W)
-            # Apply mat_by_vec to the reshaped channel
-            result_channel = self.mat_by_vec(self._U, v_channel_reshaped)  # Shape (N, M.shape[0])
-            results.append(result_channel)
+        # multiply the image by U_col from the left and by U_row^T from the right
+        temp = self.mat_by_img(self.U_col, vec.to(self.dtype))
+        return self.img_by_mat(temp, self.U_row.transpose(0, 1)).reshape(vec.shape[0], -1)
+
+    def Ut(self, vec):
+        # multiply the image by U_col^T from the left and by U_row from the right
+        temp = self.mat_by_img(self.U_col.transpose(0, 1), vec.to(self.dtype))
+        return self.img_by_mat(temp, self.U_row).reshape(vec.shape[0], -1)
+
+    def singulars(self):
+        return self._singulars.repeat(self.channels)
 
-            # Stack the results to maintain the channel dimension
-        output = torch.stack(results, dim=1)  # Shape (N, C, M.shape[0])
+    def coeff_shape(self):
+        return (self.channels, self.dim ** 2)
+
+    def singulars_compact(self):
+        return self._singulars.reshape(1, 1, -1)
+
+    def observed_compact(self):
+        return None
+
+    def add_zeros(self, vec):
+        return vec.clone().reshape(vec.shape[0], -1)
+
+
+def deconvolution_operator(kernel, dim, device, real_fft=False, dtype=torch.complex128, separable_tol=None,
+                           cachedir=None, channels=3):
+    """
+    Builds the deconvolution operator of a PSF: the spectral deconvolution_BCCB, or, when
+    separable_tol >= 0 and the PSF is separable within it, the Kronecker-factored
+    deconvolution_separable. The routing is opt-in: the V of deconvolution_BCCB (ifft2) is
+    unnormalized while the separable one is orthonormal, so the sampler's noise, and thus the
+    samples, differ between the two for the same blur.
+    """
+    # a stack of PSFs always goes through the (per-sample) spectral operator
+    multiple = isinstance(kernel, (list, tuple)) or kernel.ndim == 3
+    factors = None if multiple else separable_factors(kernel, separable_tol)
+    if factors is not None:
+        real_dtype = torch.float32 if dtype == torch.complex64 else torch.float64
+        return deconvolution_separable(factors[0], factors[1], channels, dim, device, dtype=real_dtype)
+    return deconvolution_BCCB(kernel, dim, device, real_fft=real_fft, dtype=dtype, cachedir=cachedir,
+                              channels=channels)
+
+
+# Reflexive deconvolution by a symmetric (not necessarily separable) PSF: with reflexive
+# boundaries its blur matrix is diagonalized by the 2D DCT-II, so V = U = C^T (x) C^T up to the signs
+# of the eigenvalues, which are folded into U. The eigenvalues are the DCT of the blurred corner
+# pixel over the DCT of that pixel. Singulars below ZERO are zeroed.
+class deconvolution_dct(deconvolution_separable):
+    def __init__(self, kernel, channels, dim, device, dtype=torch.float32, ZERO=0):
+        self.channels = channels
+        self.dim = dim
+        self.device = device
+        self.dtype = dtype
+        C = dct_matrix(dim)
+        basis = C.transpose(0, 1).to(device, dtype)
+        self.U_col, self.V_col, self.U_row, self.V_row = basis, basis, basis, basis
+        eigenvalues = (C @ blur_column(kernel, dim, 'reflexive') @ C.transpose(0, 1)) / torch.outer(C[:, 0], C[:, 0])
+        self._signs = torch.where(eigenvalues < 0, -1.0, 1.0).reshape(-1).to(device, dtype)
+        singulars = eigenvalues.abs().to(device, dtype)
+        singulars[singulars < ZERO] = 0
+        self._singulars = singulars.reshape(-1)
 
-        return output.reshape(vec.shape[0], -1)  # Return the output in the shape (N, C * M.shape[0])
+    def U(self, vec):
+        temp = vec.reshape(vec.shape[0], self.channels, -1) * self._signs
+        return super().U(temp.reshape(vec.shape[0], -1))
 
     def Ut(self, vec):
-        vec = vec.reshape(1,3,128,128)
-        results = []
-        for channel in range(self.channels):
-            v_channel = vec[:, channel, :, :]  # Shape (N, H, W)
-            v_channel_reshaped = v_channel.view(vec.shape[0], -1)  # Shape (N, H*W)
-            # Apply mat_by_vec to the reshaped channel
-            result_channel = self.mat_by_vec(self._Ut, v_channel_reshaped)  # Shape (N, M.shape[0])
-            results.append(result_channel)
+        temp = super().Ut(vec).reshape(vec.shape[0], self.channels, -1) * self._signs
+        return temp.reshape(vec.shape[0], -1)
+
+
+# Any PSF and boundary: the dense SVD of the (dim^2, dim^2) blur matrix of one channel, shared by
+# the channels. It stores two dense dim^2 x dim^2 factors, so it is meant for small images.
+# Singulars below ZERO are zeroed.
+class deconvolution_dense(H_functions):
+    def __init__(self, kernel, channels, dim, device, boundary='reflexive', dtype=torch.float32, ZERO=0):
+        self.channels = channels
+        self.dim = dim
+        self.dtype = dtype
+        U, singulars, Vh = torch.linalg.svd(blur_matrix(kernel, dim, boundary))
+        self.U_mat, self.Vh = U.to(device, dtype), Vh.to(device, dtype)
+        singulars = singulars.to(device, dtype)
+        singulars[singulars < ZERO] = 0
+        self._singulars = singulars
 
-            # Stack the results to maintain the channel dimension
-        output = torch.stack(results, dim=1)  # Shape (N, C, M.shape[0])
+    def planes(self, vec):
+        return vec.to(self.dtype).reshape(vec.shape[0] * self.channels, self.dim ** 2)
 
-        return output.reshape(vec.shape[0], -1)  # Return the output in the shape (N, C * M.shape[0])
+    def V(self, vec):
+        return (self.planes(vec) @ self.Vh).reshape(vec.shape[0], -1)
+
+    def Vt(self, vec):
+        return (self.planes(vec) @ self.Vh.transpose(0, 1)).reshape(vec.shape[0], -1)
+
+    def U(self, vec):
+        return (self.planes(vec) @ self.U_mat.transpose(0, 1)).reshape(vec.shape[0], -1)
+
+    def Ut(self, vec):
+        return (self.planes(vec) @ self.U_mat).reshape(vec.shape[0], -1)
 
     def singulars(self):
-        return torch.diag(self._singulars).repeat_interleave(3).reshape(-1)
+        return self._singulars.repeat(self.channels)
+
+    def coeff_shape(self):
+        return (self.channels, self.dim ** 2)
+
+    def singulars_compact(self):
+        return self._singulars.reshape(1, 1, -1)
+
+    def observed_compact(self):
+        return None
 
     def add_zeros(self, vec):
-        out = torch.zeros(vec.shape[0], self._V.shape[0], device=vec.device)
-        out[:, :self._U.shape[0]] = vec.clone().reshape(vec.shape[0], -1)
-        return out
+        return vec.clone().reshape(vec.shape[0], -1)
+
+
+def deconvolution_BCCB_br(kernel, dim, device, boundary='reflexive', channels=3, dtype=torch.float32,
+                          separable_tol=1e-6, dense_max_dim=64):
+    """
+    Boundary-respecting deconvolution, with zero or reflexive boundaries instead of circular ones:
+    the Kronecker-factored deconvolution_separable for separable PSFs (within separable_tol), the
+    DCT-diagonalized deconvolution_dct for symmetric PSFs with reflexive boundaries, and the dense
+    deconvolution_dense for any other PSF on images of at most dense_max_dim pixels a side.
+    Other PSFs are out of scope at larger sizes (there is no fast exact SVD of their blur matrix),
+    including the bundled ultrasound PSFs, which are neither separable nor symmetric
+    """
+    (kernel_col, kernel_row), residual = rank1_svd(kernel)
+    if separable_tol is not None and residual <= separable_tol:
+        return deconvolution_separable(kernel_col, kernel_row, channels, dim, device, boundary=boundary, dtype=dtype,
+                                       ZERO=1e-3)
+    if boundary == 'reflexive' and symmetric_psf(kernel):
+        return deconvolution_dct(kernel, channels, dim, device, dtype=dtype, ZERO=1e-3)
+    if dim <= dense_max_dim:
+        return deconvolution_dense(kernel, channels, dim, device, boundary=boundary, dtype=dtype, ZERO=1e-3)
+    raise ValueError("deconvolution_BCCB_br supports separable PSFs, symmetric PSFs with reflexive boundaries "
+                     "and, up to {} pixels a side, any PSF: this one leaves out {:.3g} of its energy in rank 1, "
+                     "is not symmetric or has {} boundaries, and the image is {} pixels a side".format(
+                         dense_max_dim, residual, boundary, dim))
 
 
 # Super Resolution
@@ -727,6 +1005,11 @@ class SRConv(H_functions):
         self._perm = torch.Tensor([self.img_dim * i + j for i in range(self.small_dim) for j in range(self.small_dim)] + \
                                   [self.img_dim * i + j for i in range(self.small_dim) for j in
                                    range(self.small_dim, self.img_dim)]).to(device).long()
+        # V-space entries are (pixel, channel) pairs, the first small_dim ** 2 pixels observed
+        self._singulars_compact = torch.zeros(1, img_dim ** 2, 1, device=device)
+        self._singulars_compact[0, :small_dim ** 2, 0] = self._singulars
+        self._observed_compact = torch.zeros(1, img_dim ** 2, 1, dtype=torch.bool, device=device)
+        self._observed_compact[0, :small_dim ** 2] = True
 
     def V(self, vec):
         # invert the permutation
@@ -771,6 +1054,15 @@ class SRConv(H_functions):
     def singulars(self):
         return self._singulars.repeat_interleave(3).reshape(-1)
 
+    def coeff_shape(self):
+        return (self.img_dim ** 2, self.channels)
+
+    def singulars_compact(self):
+        return self._singulars_compact
+
+    def observed_compact(self):
+        return self._observed_compact
+
     def add_zeros(self, vec):
         reshaped = vec.clone().reshape(vec.shape[0], -1)
         temp = torch.zeros((vec.shape[0], reshaped.shape[1] * self.ratio ** 2), device=vec.device)
@@ -823,12 +1115,6 @@ class Deblurring(H_functions):
         temp = self.img_by_mat(temp, self.V_small).reshape(vec.shape[0], self.channels, -1)
         # permute the entries according to the singular values
         temp = temp[:, :, self._perm].permute(0, 2, 1)
-        
-        import scipy.io
-
-        scipy.io.savemat('data.mat', {'vec': vec.detach().cpu().numpy(), 'output': temp.detach().cpu().numpy(),
-                                      'vec_output': temp.reshape(vec.shape[0], -1).reshape(vec.shape[0], -1).detach().cpu().numpy()})
-       
         return temp.reshape(vec.shape[0], -1)
 
     def U(self, vec):
@@ -850,10 +1136,17 @@ class Deblurring(H_functions):
         return temp.reshape(vec.shape[0], -1)
 
     def singulars(self):
-        import scipy.io
-        scipy.io.savemat('H_values.mat', {'singulars_vec': self._singulars.repeat(1, 3).reshape(-1).detach().cpu().numpy(),'singulars_vec': self._singulars.repeat(1, 3).reshape(-1).detach().cpu().numpy()})
-    
-        return self._singulars.repeat(1, 3).reshape(-1)
+        # Vt lays the V space out pixel-major, (HW, C), as SRConv does
+        return self._singulars.repeat_interleave(self.channels).reshape(-1)
+
+    def coeff_shape(self):
+        return (self.img_dim ** 2, self.channels)
+
+    def singulars_compact(self):
+        return self._singulars.reshape(1, -1, 1)
+
+    def observed_compact(self):
+        return None
 
     def add_zeros(self, vec):
         return vec.clone().reshape(vec.shape[0], -1)
@@ -60,6 +60,22 @@ def parse_args_and_config():
     parser.add_argument(
         "--timesteps", type=int, default=1000, help="number of steps involved"
     )
+    parser.add_argument(
+        "--skip_type", type=str, default=None,
+        help="Spacing of the timesteps: uniform | quad | logsnr | list (default: sampling.skip_type)"
+    )
+    parser.add_argument(
+        "--timestep_list", type=int, nargs="+", default=None,
+        help="Timesteps visited with --skip_type list (default: sampling.timestep_list)"
+    )
+    parser.add_argument(
+        "--sampler", type=str, default=None,
+        help="Update of the sampler: ddrm | dpmpp2m (second order multistep; default: sampling.sampler)"
+    )
+    parser.add_argument(
+        "--start_t", type=int, default=None,
+        help="Warm start: run only the timesteps <= start_t, from the noised pseudo inverse of y (default: sampling.start_t, -1 disables)"
+    )
     parser.add_argument(
         "--deg", type=str, required=True, help="Degradation"
     )
@@ -72,6 +88,10 @@ def parse_args_and_config():
     parser.add_argument(
         "--etaB", type=float, default=1, help="Eta_b (before)"
     )
+    parser.add_argument(
+        "--psf", type=str, nargs="+", default=None,
+        help="Name(s) of the PSF(s) in the PSF bank, e.g. psf_GT_1 (deblur_bccb)"
+    )
     parser.add_argument(
         '--subset_start', type=int, default=-1
     )
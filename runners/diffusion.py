@@ -94,6 +94,39 @@ def get_beta_schedule(beta_schedule, *, beta_start, beta_end, num_diffusion_time
     return betas
 
 
+def get_timestep_sequence(skip_type, betas, timesteps, timestep_list=None):
+    """
+    Increasing timesteps visited by the sampler (seq of efficient_generalized_steps).
+    uniform: every num_timesteps // timesteps steps, quad: denser near t = 0,
+    logsnr: uniform in log-SNR, list: the given timestep_list.
+    """
+    num_timesteps = betas.shape[0]
+    if skip_type == "uniform":
+        skip = num_timesteps // timesteps
+        seq = range(0, num_timesteps, skip)
+    elif skip_type == "quad":
+        seq = np.linspace(0, np.sqrt(num_timesteps * 0.8), timesteps) ** 2
+    elif skip_type == "logsnr":
+        alphas_cumprod = np.cumprod(1.0 - np.asarray(betas, dtype=np.float64))
+        logsnr = np.log(alphas_cumprod / (1.0 - alphas_cumprod))
+        targets = np.linspace(logsnr[0], logsnr[-1], timesteps)
+        # log-SNR decreases with t: search it reversed
+        seq = num_timesteps - 1 - np.searchsorted(logsnr[::-1], targets[::-1])[::-1]
+        seq = np.clip(seq, 0, num_timesteps - 1)
+    elif skip_type == "list":
+        if not timestep_list:
+            raise ValueError("skip_type list needs a timestep list (--timestep_list or sampling.timestep_list)")
+        seq = timestep_list
+    else:
+        raise NotImplementedError(skip_type)
+    if skip_type != "uniform":
+        # rounding may merge steps near t = 0
+        seq = sorted(set(int(t) for t in seq))
+        if seq[0] < 0 or seq[-1] >= num_timesteps:
+            raise ValueError("timesteps must lie in [0, {})".format(num_timesteps))
+    return seq
+
+
 class Diffusion(object):
     def __init__(self, args, config, device=None):
         self.args = args
@@ -326,12 +359,16 @@ class Diffusion(object):
             kernel1 = torch.Tensor([pdf(-4), pdf(-3), pdf(-2), pdf(-1), pdf(0), pdf(1), pdf(2), pdf(3), pdf(4)]).to(self.device)
             H_funcs = Deblurring2D(kernel1 / kernel1.sum(), kernel2 / kernel2.sum(), config.data.channels, self.config.data.image_size, self.device)
 
-        elif deg == 'deblur_bccb':
-            from functions.svd_replacement import deconvolution_BCCB
+        elif deg == 'deblur_bccb' or deg == 'deblur_bccb_br':
+            from functions.svd_replacement import deconvolution_operator, deconvolution_BCCB_br
+            from functions.psf_bank import load_psf
 
             if config.data.dataset == 'us_images':
-                psf = scipy.io.loadmat('psf_GT_0.mat')
-                kernel = psf['psf_ref']
+                # PSFs from the PSF bank, by name (--psf overrides the config);
+                # several PSFs give a per-sample operator, indexed by the dataset's psf_index
+                psf_names = args.psf if args.psf is not None else getattr(config.data, 'psf_files', ['psf_GT_0'])
+                kernels = [load_psf(name) for name in psf_names]
+                kernel = kernels[0] if len(kernels) == 1 else kernels
             else:
                 sigma = 20
                 kernel_size = 20
@@ -341,7 +378,20 @@ class Diffusion(object):
                 kernel_1d = kernel_1d/kernel_1d.sum()
                 kernel = kernel_1d.view(-1, 1) @ kernel_1d.view(1, -1)
 
-            H_funcs = deconvolution_BCCB( kernel,self.config.data.image_size, self.device)
+            real_fft = getattr(config.sampling, 'real_fft', False)
+            spectral_dtype = getattr(torch, getattr(config.sampling, 'spectral_dtype', 'complex128'))
+            separable_tol = getattr(config.sampling, 'separable_tol', -1)
+            psf_cache = getattr(config.sampling, 'psf_cache', os.path.join(args.exp, 'psf_cache'))
+            if deg == 'deblur_bccb_br':
+                if isinstance(kernel, list):
+                    print("ERROR: deblur_bccb_br supports a single PSF")
+                    quit()
+                H_funcs = deconvolution_BCCB_br(kernel, self.config.data.image_size, self.device,
+                                                channels=config.data.channels)
+            else:
+                H_funcs = deconvolution_operator(kernel, self.config.data.image_size, self.device, real_fft=real_fft,
+                                                 dtype=spectral_dtype, separable_tol=separable_tol, cachedir=psf_cache,
+                                                 channels=config.data.channels)
             blur_by = 1
         
         elif deg[:2] == 'sr':
@@ -355,6 +405,7 @@ class Diffusion(object):
         else:
             print("ERROR: degradation type not supported")
             quit()
+        H_funcs.pinv_reg = getattr(config.sampling, 'pinv_reg', 0.0)
         args.sigma_0 = 2 * args.sigma_0 #to account for scaling to [-1,1]
         sigma_0 = args.sigma_0
         
@@ -364,12 +415,18 @@ class Diffusion(object):
         avg_psnr = 0.0
         psnr_list = []
         x0_preds = []
+        # sampler metrics, accumulated on the device over the batches
+        stats = {}
         pbar = tqdm.tqdm(val_loader)
         for x_orig, classes in pbar:
             x_orig = x_orig.to(self.device)
             # x_orig = x_orig[:, 0, :, :]  
             x_orig = data_transform(self.config, x_orig)
 
+            if len(getattr(H_funcs, 'kernels', [])) > 1:
+                psf_index = getattr(dataset, 'psf_index', [0] * len(dataset))
+                H_funcs.set_kernel_index(psf_index[idx_so_far:idx_so_far + x_orig.shape[0]])
+
             if self.config.model.degradation:
                 y_0 = H_funcs.H(x_orig)
                 
@@ -405,7 +462,8 @@ class Diffusion(object):
             
             # NOTE: This means that we are producing each predicted x0, not x_{t-1} at timestep t.
             with torch.no_grad():
-                x, x0_preds_batch = self.sample_image(x, model, H_funcs, y_0, sigma_0, last=False, cls_fn=cls_fn, classes=classes)
+                x, x0_preds_batch = self.sample_image(x, model, H_funcs, y_0, sigma_0, last=False, cls_fn=cls_fn, classes=classes, stats=stats,
+                                                      snapshot_dir=os.path.join(self.args.image_folder, f"trajectory_{idx_so_far}"))
 
             #x0_preds.append(x0_preds_batch)
 
@@ -433,20 +491,43 @@ class Diffusion(object):
             if self.config.model.known_GT:
                 pbar.set_description("PSNR: %.2f" % (avg_psnr / (idx_so_far - idx_init)))
                 
+        # a single sync for the whole run
+        nonfinite = int(stats.get('nonfinite', 0))
         if self.config.model.known_GT:
             psnr_cpu = [p.cpu().numpy() for p in psnr_list]
-            scipy.io.savemat(os.path.join(folder_path, 'psnr_values.mat'), {'psnr': psnr_cpu})
+            scipy.io.savemat(os.path.join(folder_path, 'psnr_values.mat'), {'psnr': psnr_cpu, 'nonfinite': nonfinite})
             avg_psnr = avg_psnr / (idx_so_far - idx_init)
             print("Total Average PSNR: %.2f" % avg_psnr)
 
         print("Number of samples: %d" % (idx_so_far - idx_init))
-
-    def sample_image(self, x, model, H_funcs, y_0, sigma_0, last=True, cls_fn=None, classes=None):
-        skip = self.num_timesteps // self.args.timesteps
-        seq = range(0, self.num_timesteps, skip)
+        print("Non-finite V-space coefficients sanitized: %d" % nonfinite)
+        if 'early_exit' in stats:
+            print("Samples converged before the last step: %d" % stats['early_exit'])
+
+    def sample_image(self, x, model, H_funcs, y_0, sigma_0, last=True, cls_fn=None, classes=None, stats=None, snapshot_dir=None, callback=None):
+        skip_type = self.args.skip_type or getattr(self.config.sampling, 'skip_type', 'uniform')
+        timestep_list = self.args.timestep_list or getattr(self.config.sampling, 'timestep_list', None)
+        seq = get_timestep_sequence(skip_type, self.betas.cpu().numpy(), self.args.timesteps, timestep_list)
+        # warm start: only the steps up to start_t, from the regularized pseudo inverse of y
+        start_t = self.args.start_t if self.args.start_t is not None else getattr(self.config.sampling, 'start_t', -1)
+        warm_start = start_t >= 0
+        if warm_start:
+            seq = [t for t in seq if t <= start_t]
+            if not seq:
+                raise ValueError("start_t {} is below the first timestep".format(start_t))
         
         x = efficient_generalized_steps(x, seq, model, self.betas, H_funcs, y_0, sigma_0, \
-            etaB=self.args.etaB, etaA=self.args.eta, etaC=self.args.eta, cls_fn=cls_fn, classes=classes)
+            etaB=self.args.etaB, etaA=self.args.eta, etaC=self.args.eta, cls_fn=cls_fn, classes=classes,
+            model_channels=getattr(self.config.model, 'in_channels', 3),
+            hermitian=getattr(self.config.sampling, 'hermitian', False),
+            compile_update=getattr(self.config.sampling, 'compile_update', False), stats=stats,
+            report_every=getattr(self.config.sampling, 'guard_report_every', 0),
+            last_only=getattr(self.config.sampling, 'last_only', False),
+            snapshot_stride=getattr(self.config.sampling, 'snapshot_stride', 0) if snapshot_dir is not None else 0,
+            snapshot_dir=snapshot_dir, callback=callback,
+            sampler=self.args.sampler or getattr(self.config.sampling, 'sampler', 'ddrm'),
+            warm_start=warm_start, start_reg=getattr(self.config.sampling, 'start_reg', 0.001),
+            conv_tol=getattr(self.config.sampling, 'conv_tol', 0.0))
         if last:
             x = x[0][-1]
         return x